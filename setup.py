@@ -24,7 +24,7 @@ setup(name='TotalSegmentator',
             'nnunetv2>=2.2.1',
             'requests==2.27.1;python_version<"3.10"',
             'requests;python_version>="3.10"',
-            'rt_utils',
+            'rt_utils>=1.2.7,<1.3',  # uses some rt_utils internals
             'dicom2nifti',
             'pyarrow'
         ],
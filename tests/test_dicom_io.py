@@ -0,0 +1,58 @@
+import unittest
+import tempfile
+from pathlib import Path
+
+import pytest
+import numpy as np
+import nibabel as nib
+import pydicom
+
+from totalsegmentator.map_to_binary import class_map
+from totalsegmentator.dicom_io import save_mask_as_rtstruct
+
+
+def save_mask_as_rtstruct_reference(img_data, selected_classes, dcm_reference_file, output_path):
+    """
+    Plain rt_utils version of save_mask_as_rtstruct (one add_roi per class).
+    """
+    from rt_utils import RTStructBuilder
+    rtstruct = RTStructBuilder.create_new(dicom_series_path=dcm_reference_file)
+    for class_idx, class_name in selected_classes.items():
+        binary_img = img_data == class_idx
+        if binary_img.sum() > 0:
+            rtstruct.add_roi(mask=np.rot90(binary_img, 1, (0, 1)), name=class_name)
+    rtstruct.save(str(output_path))
+
+
+class test_dicom_io(unittest.TestCase):
+
+    def test_rtstruct_same_as_rt_utils(self):
+        dcm_dir = "tests/reference_files/example_ct_dicom"
+        img_data = np.asanyarray(nib.load("tests/reference_files/example_seg_dicom.nii.gz").dataobj).astype(np.uint8)
+        selected_classes = class_map["total"]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            save_mask_as_rtstruct(img_data, selected_classes, dcm_dir, Path(tmp_dir) / "new.dcm")
+            save_mask_as_rtstruct_reference(img_data, selected_classes, dcm_dir, Path(tmp_dir) / "ref.dcm")
+            ds_new = pydicom.dcmread(Path(tmp_dir) / "new.dcm")
+            ds_ref = pydicom.dcmread(Path(tmp_dir) / "ref.dcm")
+
+        # everything apart from the generated UIDs and dates has to be the same
+        rois_new = [(r.ROINumber, r.ROIName) for r in ds_new.StructureSetROISequence]
+        rois_ref = [(r.ROINumber, r.ROIName) for r in ds_ref.StructureSetROISequence]
+        self.assertEqual(rois_new, rois_ref, "ROI names or numbers differ")
+        self.assertEqual([r.ObservationNumber for r in ds_new.RTROIObservationsSequence],
+                         [r.ObservationNumber for r in ds_ref.RTROIObservationsSequence])
+
+        self.assertEqual(len(ds_new.ROIContourSequence), len(ds_ref.ROIContourSequence))
+        for roi_new, roi_ref in zip(ds_new.ROIContourSequence, ds_ref.ROIContourSequence):
+            self.assertEqual(list(roi_new.ROIDisplayColor), list(roi_ref.ROIDisplayColor))
+            self.assertEqual(len(roi_new.ContourSequence), len(roi_ref.ContourSequence))
+            for contour_new, contour_ref in zip(roi_new.ContourSequence, roi_ref.ContourSequence):
+                self.assertEqual(contour_new.ContourImageSequence[0].ReferencedSOPInstanceUID,
+                                 contour_ref.ContourImageSequence[0].ReferencedSOPInstanceUID)
+                self.assertEqual(list(contour_new.ContourData), list(contour_ref.ContourData))
+
+
+if __name__ == '__main__':
+    pytest.main(["-v", "tests/test_dicom_io.py"])
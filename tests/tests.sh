@@ -4,6 +4,9 @@ set -e
 # ./tests/tests.sh
 
 
+# Test dicom rt struct export (no prediction needed)
+pytest -v tests/test_dicom_io.py
+
 # Test multilabel prediction
 TotalSegmentator -i tests/reference_files/example_ct_sm.nii.gz -o tests/unittest_prediction.nii.gz -bs --ml -d cpu
 pytest -v tests/test_end_to_end.py::test_end_to_end::test_prediction_multilabel
@@ -8,6 +8,15 @@ from pathlib import Path
 from totalsegmentator.python_api import totalsegmentator
 
 
+def validate_device_type(value):
+    if value in ["gpu", "cpu", "mps"]:
+        return value
+    # also allow "gpu:X" to select a specific gpu
+    if value.startswith("gpu:") and value[4:].isdigit():
+        return value
+    raise argparse.ArgumentTypeError(f"Invalid device type: '{value}'. Must be 'gpu', 'cpu', 'mps' or 'gpu:X' where X is an integer.")
+
+
 def main():
     parser = argparse.ArgumentParser(description="Segment 104 anatomical structures in CT images.",
                                      epilog="Written by Jakob Wasserthal. If you use this tool please cite https://pubs.rsna.org/doi/10.1148/ryai.230024")
@@ -103,8 +112,8 @@ def main():
     # "mps" is for apple silicon; the latest pytorch nightly version supports 3D Conv but not ConvTranspose3D which is
     # also needed by nnU-Net. So "mps" not working for now.
     # https://github.com/pytorch/pytorch/issues/77818
-    parser.add_argument("-d", "--device", choices=["gpu", "cpu", "mps"],
-                        help="Device to run on (default: gpu).",
+    parser.add_argument("-d", "--device", type=validate_device_type,
+                        help="Device to run on: gpu | cpu | mps | gpu:X (e.g. gpu:1 for the second gpu) (default: gpu).",
                         default="gpu")
 
     parser.add_argument("-q", "--quiet", action="store_true", help="Print no intermediate outputs",
@@ -3,18 +3,51 @@ import sys
 import time
 import shutil
 import zipfile
+import gzip
+import struct
 from pathlib import Path
 import subprocess
 import platform
+import hashlib
+import tempfile
+import atexit
+import threading
+from functools import partial, lru_cache
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 from tqdm import tqdm
 import numpy as np
 import nibabel as nib
+import pydicom
+from pydicom.uid import UID
+from pydicom.errors import InvalidDicomError
 import dicom2nifti
+from dicom2nifti.common import is_valid_imaging_dicom
+from dicom2nifti.convert_dicom import dicom_array_to_nifti
 
 from totalsegmentator.config import get_weights_dir
 
 
+# Compare the raw UID values (a set lookup) instead of resolving the UID names for every file
+supported_sop_classes = frozenset([
+    "1.2.840.10008.5.1.4.1.1.2",     # CT Image Storage
+    "1.2.840.10008.5.1.4.1.1.2.1",   # Enhanced CT Image Storage
+    "1.2.840.10008.5.1.4.1.1.4",     # MR Image Storage
+    "1.2.840.10008.5.1.4.1.1.4.1",   # Enhanced MR Image Storage
+    "1.2.840.10008.5.1.4.1.1.128",   # Positron Emission Tomography Image Storage
+    "1.2.840.10008.5.1.4.1.1.20",    # Nuclear Medicine Image Storage
+])
+
+_nifti_cache_dir = None  # tmp dir for converted dicom series (see dcm_to_nifti)
+_nifti_cache_lock = threading.Lock()
+_rt_utils = None  # rt_utils module, imported on first use (see _import_rt_utils)
+
+# Header tags needed to find and sort the image slices of a series
+header_tags = ["SOPClassUID", "SeriesInstanceUID", "InstanceNumber",
+               "ImageOrientationPatient", "ImagePositionPatient",
+               "SharedFunctionalGroupsSequence", "PerFrameFunctionalGroupsSequence"]
+
 
 def command_exists(command):
     return shutil.which(command) is not None
@@ -22,7 +55,6 @@ def command_exists(command):
 
 def download_dcm2niix():
     import urllib.request
-    print("  Downloading dcm2niix...")
 
     if platform.system() == "Windows":
         # url = "https://github.com/rordenlab/dcm2niix/releases/latest/download/dcm2niix_win.zip"
@@ -43,22 +75,52 @@ def download_dcm2niix():
         raise ValueError("Unknown operating system. Can not download the right version of dcm2niix.")
 
     config_dir = get_weights_dir()
-
-    urllib.request.urlretrieve(url, config_dir / "dcm2niix.zip")
-    with zipfile.ZipFile(config_dir / "dcm2niix.zip", 'r') as zip_ref:
-        zip_ref.extractall(config_dir)
-
-    # Give execution permission to the script
-    if platform.system() == "Windows":
-        os.chmod(config_dir / "dcm2niix.exe", 0o755)
-    else:
-        os.chmod(config_dir / "dcm2niix", 0o755)
-
-    # Clean up
-    if (config_dir / "dcm2niix.zip").exists():
-        os.remove(config_dir / "dcm2niix.zip")
-    if (config_dir / "dcm2niibatch").exists():
-        os.remove(config_dir / "dcm2niibatch")
+    config_dir.mkdir(exist_ok=True, parents=True)
+    binary_name = "dcm2niix.exe" if platform.system() == "Windows" else "dcm2niix"
+    dcm2niix = config_dir / binary_name
+
+    # Several processes (e.g. cluster jobs) might install dcm2niix at the same time. The lock lets
+    # the others wait instead of downloading again and overwriting the binary while it is in use.
+    with _file_lock(config_dir / "dcm2niix.lock"):
+        if dcm2niix.exists():
+            return
+        print("  Downloading dcm2niix...")
+
+        # Download and extract into temporary files and only move the finished binary into place.
+        # An interrupted download then does not leave a broken binary behind.
+        tmp_dir = Path(tempfile.mkdtemp(prefix="tmp_dcm2niix_", dir=config_dir))
+        try:
+            zip_file = tmp_dir / "dcm2niix.zip"
+            with urllib.request.urlopen(url) as r, open(zip_file, "wb") as f:
+                shutil.copyfileobj(r, f, length=1024 * 1024)  # default buffer size is very small
+            with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+                if zip_ref.testzip() is not None:
+                    raise ValueError("Downloaded dcm2niix zip file is corrupt.")
+                zip_ref.extract(binary_name, tmp_dir)
+
+            # Give execution permission to the script
+            os.chmod(tmp_dir / binary_name, 0o755)
+            os.replace(tmp_dir / binary_name, dcm2niix)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+@contextmanager
+def _file_lock(lock_file):
+    """
+    Exclusive lock across processes. Does nothing on systems without fcntl (Windows).
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(lock_file, "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
 
 
 def dcm_to_nifti_LEGACY(input_path, output_path, verbose=False):
@@ -111,39 +173,326 @@ def dcm_to_nifti_LEGACY(input_path, output_path, verbose=False):
     os.remove(str(output_path)[:-7] + ".json")
 
 
-def dcm_to_nifti(input_path, output_path, verbose=False):
+def _get_sop_class_uid(dcm):
+    # Some anonymizers empty the SOPClassUID. Then use the one from the file meta header.
+    sop_class_uid = dcm.get("SOPClassUID", "")
+    if not sop_class_uid:
+        sop_class_uid = getattr(dcm, "file_meta", {}).get("MediaStorageSOPClassUID", "")
+    return UID(sop_class_uid)
+
+
+def _has_dicom_preamble(file_path):
+    """
+    Check for the "DICM" magic bytes after the 128 byte preamble of a dicom file.
+    """
+    with open(file_path, "rb") as f:
+        f.seek(128)
+        return f.read(4) == b"DICM"
+
+
+def _slice_position(dcm):
+    """
+    Position of the slice along the slice normal (like dicom2nifti and rt_utils sort the slices).
+    Falls back to InstanceNumber if the header has no position (e.g. enhanced multiframe files).
+    """
+    if "ImagePositionPatient" in dcm and "ImageOrientationPatient" in dcm:
+        orientation = np.array(dcm.ImageOrientationPatient, dtype=np.float64)
+        normal = np.cross(orientation[:3], orientation[3:])
+        return 0, float(np.dot(normal, np.array(dcm.ImagePositionPatient, dtype=np.float64)))
+    return 1, int(dcm.get("InstanceNumber") or 0)
+
+
+def _read_dicom_header(file_path):
+    """
+    Only read the few header tags needed to check if the file is a supported image slice.
+
+    Only returns plain python objects, so this can also run in a process pool.
+
+    returns: (file_path, slice position) if the file is a supported image slice, otherwise None
+    """
+    try:
+        # Skip other files (README, thumbnails, ...) without parsing them. Files without
+        # preamble are also not read by dicom2nifti by default.
+        if not _has_dicom_preamble(file_path):
+            return None
+        dcm = pydicom.dcmread(file_path, defer_size="1 KB", stop_before_pixels=True,
+                              specific_tags=header_tags)
+        if _get_sop_class_uid(dcm) in supported_sop_classes and is_valid_imaging_dicom(dcm):
+            return file_path, _slice_position(dcm)
+    except (InvalidDicomError, EOFError, ValueError, struct.error):
+        # Broken or not really a dicom file. Errors like missing permissions should not be hidden.
+        pass
+    return None
+
+
+def _scan_files(path, _visited_dirs=None):
+    """
+    Recursively yield os.DirEntry objects of all files below path. Symlinks are followed (like
+    copytree in dicom2nifti does), broken symlinks are skipped.
+
+    os.scandir gets the file type from the directory listing, so no extra stat call per file is needed.
+    """
+    # guard against symlink loops
+    if _visited_dirs is None:
+        _visited_dirs = set()
+    stat = os.stat(path)
+    if (stat.st_dev, stat.st_ino) in _visited_dirs:
+        return
+    _visited_dirs.add((stat.st_dev, stat.st_ino))
+
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                is_dir, is_file = entry.is_dir(), entry.is_file()
+            except OSError:
+                continue
+            if is_dir:
+                yield from _scan_files(entry.path, _visited_dirs)
+            elif is_file:
+                yield entry
+
+
+@lru_cache(maxsize=4)
+def _find_dicom_slices(dicom_dir, fingerprint, nr_threads, min_files_for_processes):
+    """
+    Read the headers of all files to find the image slices. Cached, because the same series is
+    needed for the conversion and for the export of the segmentation.
+
+    fingerprint: only used as part of the cache key (changes if a file in the directory changes)
+
+    returns: tuple of paths of all image slices sorted by slice position
+    """
+    file_paths = [entry.path for entry in _scan_files(dicom_dir)]
+    if len(file_paths) >= min_files_for_processes and (os.cpu_count() or 1) > 1:
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            headers = list(executor.map(_read_dicom_header, file_paths, chunksize=32))
+    else:
+        with ThreadPoolExecutor(max_workers=nr_threads) as executor:
+            headers = list(executor.map(_read_dicom_header, file_paths))
+    slices = sorted((s for s in headers if s is not None), key=lambda s: s[1])
+    return tuple(file_path for file_path, _ in slices)
+
+
+def load_dicom_series(dicom_dir, nr_threads=None, min_files_for_processes=1000, stop_before_pixels=False):
     """
-    Uses dicom2nifti package (also works on windows)
+    Read all image slices in a directory (and its subdirectories).
+
+    First only the headers of all files are read to find the image slices. Then only these are read
+    completely. Reading is mostly waiting for disk io, therefore the files are read by several threads.
+    For large series parsing the headers becomes cpu bound, therefore they are parsed by several
+    processes.
+
+    dicom_dir: a directory of dicom slices
+    nr_threads: number of threads for reading (default: min(32, 4*nr_cpus))
+    min_files_for_processes: use a process pool for the headers if there are at least this many files
+    stop_before_pixels: only read the headers of the image slices
+
+    returns: list of pydicom datasets sorted by slice position
+    """
+    if nr_threads is None:
+        nr_threads = min(32, (os.cpu_count() or 1) * 4)
+    dicom_dir = os.path.abspath(dicom_dir)
+    slice_paths = _find_dicom_slices(dicom_dir, _dicom_dir_fingerprint(dicom_dir), nr_threads, min_files_for_processes)
+
+    with ThreadPoolExecutor(max_workers=nr_threads) as executor:
+        # no defer_size here, otherwise the pixel data would only be read later on the main thread
+        read_file = partial(pydicom.dcmread, stop_before_pixels=stop_before_pixels, force=True)
+        dicoms = list(executor.map(read_file, slice_paths))
+    return dicoms
+
+
+def _dicom_dir_fingerprint(dicom_dir):
+    """
+    Hash of the path, size and modification time of all files in the directory.
+    """
+    fingerprint = hashlib.sha1(str(Path(dicom_dir).absolute()).encode())
+    for entry in sorted(_scan_files(dicom_dir), key=lambda entry: entry.path):
+        try:
+            stat = entry.stat()
+        except OSError:  # e.g. file was removed in the meantime
+            continue
+        fingerprint.update(f"{entry.path}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return fingerprint.hexdigest()
+
+
+def _get_nifti_cache_dir():
+    global _nifti_cache_dir
+    if _nifti_cache_dir is None:
+        _nifti_cache_dir = Path(tempfile.mkdtemp(prefix="totalseg_dcm_cache_"))
+        atexit.register(shutil.rmtree, _nifti_cache_dir, ignore_errors=True)
+    return _nifti_cache_dir
+
+
+@lru_cache(maxsize=None)
+def _find_dcm2niix():
+    """
+    returns: dcm2niix binary if it is installed or was already downloaded, otherwise None
+    """
+    if command_exists("dcm2niix"):
+        return "dcm2niix"
+    dcm2niix = get_weights_dir() / ("dcm2niix.exe" if platform.system() == "Windows" else "dcm2niix")
+    return str(dcm2niix) if dcm2niix.exists() else None
+
+
+def _dcm2niix_to_nifti(dcm2niix, input_path, output_path, verbose=False):
+    """
+    Convert with dcm2niix. Is a lot faster than dicom2nifti for big series.
+
+    output_path: an uncompressed nifti file path (.nii)
+
+    returns: True if dcm2niix converted the directory to exactly one image, otherwise False
+    """
+    output = None if verbose else subprocess.DEVNULL
+    with tempfile.TemporaryDirectory(prefix="totalseg_dcm2niix_") as tmp_dir:
+        result = subprocess.run([dcm2niix, "-z", "n", "-b", "n", "-f", "converted", "-o", tmp_dir,
+                                 str(input_path)], stdout=output, stderr=output)
+        nii_files = list(Path(tmp_dir).glob("*.nii"))
+        if result.returncode != 0 or len(nii_files) != 1:
+            return False
+        shutil.move(nii_files[0], output_path)
+    return True
+
+
+def _save_as_integer_image(nii, file_path):
+    """
+    dicom2nifti returns float64 images. Save them with the smallest fitting integer dtype if all
+    values are integers (e.g. CT), which makes the file 4 times smaller.
+    """
+    data = np.asanyarray(nii.dataobj)
+    if not np.issubdtype(data.dtype, np.floating) or data.size == 0 or not np.all(np.mod(data, 1) == 0):
+        return
+    for dtype in (np.int16, np.int32):
+        if np.iinfo(dtype).min <= data.min() and data.max() <= np.iinfo(dtype).max:
+            header = nii.header.copy()
+            header.set_data_dtype(dtype)
+            nib.save(nib.Nifti1Image(data.astype(dtype), nii.affine, header), file_path)
+            return
+
+
+def dcm_to_nifti(input_path, output_path, verbose=False, use_dcm2niix=True):
+    """
+    Uses dcm2niix if it is installed (not on windows) and dicom2nifti otherwise (also works on windows).
+
+    The converted image of the last dicom series is kept until the python process ends. If the same
+    series is converted again (e.g. for the rough segmentation used for cropping and then for the
+    actual segmentation or when running several tasks) the cached image is used.
 
     input_path: a directory of dicom slices
-    output_path: a nifti file path
+    output_path: a nifti file path (.nii is faster than .nii.gz). Must not be modified, because a
+                 .nii file can be a hard link to the cached image.
+    use_dcm2niix: if False always use dicom2nifti (e.g. if the orientation has to be the one of dicom2nifti)
     """
-    dicom2nifti.dicom_series_to_nifti(input_path, output_path, reorient_nifti=True)
+    dcm2niix = _find_dcm2niix() if use_dcm2niix and platform.system() != "Windows" else None
+    backend = "dcm2niix" if dcm2niix is not None else "dicom2nifti"
+    # the cached image is not compressed, which saves the gzip encoding and decoding of the whole image
+    cached_file = _get_nifti_cache_dir() / f"{_dicom_dir_fingerprint(input_path)}_{backend}.nii"
+
+    # Only one conversion at a time, otherwise a thread could delete the cached file of another one
+    with _nifti_cache_lock:
+        if not cached_file.exists():
+            # only keep the last converted series
+            for old_file in _get_nifti_cache_dir().glob("*.nii"):
+                old_file.unlink()
+
+            # convert to a tmp file first, so that a failed conversion does not leave a partial cached file
+            tmp_file = cached_file.with_name(f"tmp_{cached_file.name}")
+            try:
+                if dcm2niix is None or not _dcm2niix_to_nifti(dcm2niix, input_path, tmp_file, verbose):
+                    if dcm2niix is not None:
+                        print("WARNING: dcm2niix could not convert the dicom series. Using dicom2nifti instead.")
+                    # Read the slices ourselves instead of using dicom2nifti.dicom_series_to_nifti. That one copies the
+                    # entire directory to a tmp dir first and then reads all files in one thread.
+                    dicoms = load_dicom_series(input_path)
+                    if len(dicoms) == 0:
+                        raise ValueError(f"No dicom slices found in {input_path}.")
+                    nii = dicom_array_to_nifti(dicoms, tmp_file, reorient_nifti=True)["NII"]
+                    _save_as_integer_image(nii, tmp_file)
+                os.replace(tmp_file, cached_file)
+            finally:
+                if tmp_file.exists():
+                    tmp_file.unlink()
+        elif verbose:
+            print("  using already converted dicom series")
+
+        if str(output_path).endswith(".nii.gz"):
+            # same compression level as nibabel uses (gzip default of 9 is much slower)
+            with open(cached_file, "rb") as f_in, gzip.open(output_path, "wb", compresslevel=1) as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        else:
+            # hard link instead of a second copy of the image (the cached file is never modified)
+            try:
+                os.link(cached_file, output_path)
+            except OSError:  # e.g. other file system
+                shutil.copy(cached_file, output_path)
 
 
-def save_mask_as_rtstruct(img_data, selected_classes, dcm_reference_file, output_path):
+def _import_rt_utils():
     """
-    dcm_reference_file: a directory with dcm slices ??
+    Import rt_utils (pulls in opencv) only when it is needed and configure logging only once.
     """
-    from rt_utils import RTStructBuilder
-    import logging
-    logging.basicConfig(level=logging.WARNING)  # avoid messages from rt_utils
+    global _rt_utils
+    if _rt_utils is None:
+        import logging
+        logging.basicConfig(level=logging.WARNING)  # avoid messages from rt_utils
+        import rt_utils
+        import rt_utils.utils
+        _rt_utils = rt_utils
+    return _rt_utils
 
-    # create new RT Struct - requires original DICOM
-    rtstruct = RTStructBuilder.create_new(dicom_series_path=dcm_reference_file)
 
-    # add mask to RT Struct
-    for class_idx, class_name in tqdm(selected_classes.items()):
-        binary_img = img_data == class_idx
-        if binary_img.sum() > 0:  # only save none-empty images
+def save_mask_as_rtstruct(img_data, selected_classes, dcm_reference_file, output_path, nr_threads=None):
+    """
+    dcm_reference_file: a directory with dcm slices ??
+    nr_threads: number of threads for creating the contours (default: min(4, nr_cpus)). Each thread holds
+                one mask of the size of the image.
+    """
+    rt_utils = _import_rt_utils()
+    RTStruct, ds_helper, ROIData = rt_utils.RTStruct, rt_utils.ds_helper, rt_utils.utils.ROIData
+
+    # Check labels before the (slow) reading of the dicom series
+    if not np.issubdtype(img_data.dtype, np.integer):
+        raise ValueError(f"Segmentation has to contain integer labels, but has dtype {img_data.dtype}.")
+    label_counts = np.bincount(img_data.ravel())
+    max_label = len(label_counts) - 1
+    if max_label > max(selected_classes, default=0):
+        raise ValueError(f"Segmentation contains label {max_label} which is not in the selected classes.")
 
-            # rotate nii to match DICOM orientation
-            binary_img = np.rot90(binary_img, 1, (0, 1))  # rotate segmentation in-plane
+    # only save none-empty images (find all labels present in one pass instead of one pass per class)
+    present_labels = set(np.flatnonzero(label_counts).tolist())
+    selected_classes = {k: v for k, v in selected_classes.items() if k in present_labels}
 
-            # add segmentation to RT Struct
-            rtstruct.add_roi(
-                mask=binary_img,  # has to be a binary numpy array
-                name=class_name
-            )
+    # create new RT Struct - requires original DICOM
+    # (same as RTStructBuilder.create_new, but that one reads and decodes all files in the directory again,
+    # while only the headers of the slices are needed; they are sorted the same way as rt_utils does)
+    series_data = load_dicom_series(dcm_reference_file, stop_before_pixels=True)
+    if len(series_data) == 0:
+        raise ValueError(f"No dicom slices found in {dcm_reference_file}.")
+    rtstruct = RTStruct(series_data, ds_helper.create_rtstruct_dataset(series_data))
+
+    # rotate nii to match DICOM orientation (rotate segmentation in-plane)
+    # Do it once for all classes and make it contiguous, so the comparisons below run on a contiguous array.
+    img_data = np.ascontiguousarray(np.rot90(img_data, 1, (0, 1)))
+
+    def create_roi(roi_number, class_idx, class_name):
+        # Same as RTStruct.add_roi, but the (slow) contours can be created in several threads, because
+        # opencv releases the GIL while finding the contours.
+        binary_img = img_data == class_idx
+        rtstruct.validate_mask(binary_img)
+        roi_data = ROIData(mask=binary_img, color=None, number=roi_number, name=class_name,
+                           frame_of_reference_uid=rtstruct.frame_of_reference_uid)
+        roi_contour = ds_helper.create_roi_contour(roi_data, series_data)
+        roi_data.mask = None  # not needed anymore; avoid keeping one mask per finished class in memory
+        return roi_data, roi_contour
+
+    # add mask to RT Struct (in the same order as with add_roi)
+    if nr_threads is None:
+        nr_threads = min(4, os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=nr_threads) as executor:
+        rois = executor.map(create_roi, range(1, len(selected_classes) + 1),
+                            selected_classes.keys(), selected_classes.values())
+        for roi_data, roi_contour in tqdm(rois, total=len(selected_classes)):
+            rtstruct.ds.ROIContourSequence.append(roi_contour)
+            rtstruct.ds.StructureSetROISequence.append(ds_helper.create_structure_set_roi(roi_data))
+            rtstruct.ds.RTROIObservationsSequence.append(ds_helper.create_rtroi_observation(roi_data))
 
     rtstruct.save(str(output_path))
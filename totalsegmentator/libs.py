@@ -315,7 +315,7 @@ def combine_masks_to_multilabel_file(masks_dir, multilabel_file):
 
     for idx, mask in enumerate(masks):
         if os.path.exists(f"{masks_dir}/{mask}.nii.gz"):
-            img = nib.load(f"{masks_dir}/{mask}.nii.gz").get_fdata()
+            img = np.asanyarray(nib.load(f"{masks_dir}/{mask}.nii.gz").dataobj)
         else:
             print(f"Mask {mask} is missing. Filling with zeros.")
             img = np.zeros(ref_img.shape)
@@ -361,7 +361,7 @@ def combine_masks(mask_dir, class_type):
     combined = np.zeros(ref_img.shape, dtype=np.uint8)
     for idx, mask in enumerate(masks):
         if (mask_dir / f"{mask}.nii.gz").exists():
-            img = nib.load(mask_dir / f"{mask}.nii.gz").get_fdata()
+            img = np.asanyarray(nib.load(mask_dir / f"{mask}.nii.gz").dataobj)
             combined[img > 0.5] = 1
 
     return nib.Nifti1Image(combined, ref_img.affine)
@@ -402,9 +402,10 @@ def reorder_multilabel_like_v1(data, label_map_v2, label_map_v1):
     Reorder a multilabel image from v2 to v1
     """
     label_map_v2_inv = {v: k for k, v in label_map_v2.items()}
-    data_out = np.zeros(data.shape, dtype=np.uint8)
+    # map all labels in one pass with a lookup table (v2 labels without v1 counterpart map to 0)
+    lut = np.zeros(max(label_map_v2_inv.values()) + 1, dtype=np.uint8)
     for label_id, label_name in label_map_v1.items():
         if label_name in label_map_v2_inv:
-            data_out[data == label_map_v2_inv[label_name]] = label_id
+            lut[label_map_v2_inv[label_name]] = label_id
         # heart chambers are not in v2 anymore. The results seg will be empty for these classes
-    return data_out
+    return lut[data]
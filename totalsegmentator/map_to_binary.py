@@ -480,4 +480,6 @@ map_taskid_to_partname = {
     517: "test",
 }
 
+map_partname_to_taskid = {v: k for k, v in map_taskid_to_partname.items()}
+
 # pprint({idx:v for idx, (k, v) in enumerate(a.items())}, sort_dicts=False)
@@ -9,7 +9,7 @@ import subprocess
 from pathlib import Path
 from os.path import join
 from typing import Union
-from functools import partial
+from functools import partial, lru_cache
 from multiprocessing import Pool
 import tempfile
 import inspect
@@ -31,7 +31,7 @@ from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
 
 from nnunetv2.utilities.file_path_utilities import get_output_folder
 
-from totalsegmentator.map_to_binary import class_map, class_map_5_parts, map_taskid_to_partname
+from totalsegmentator.map_to_binary import class_map, class_map_5_parts, map_taskid_to_partname, map_partname_to_taskid
 from totalsegmentator.alignment import as_closest_canonical_nifti, undo_canonical_nifti
 from totalsegmentator.alignment import as_closest_canonical, undo_canonical
 from totalsegmentator.resampling import change_spacing
@@ -85,7 +85,7 @@ def contains_empty_img(imgs):
     """
     is_empty = True
     for img in imgs:
-        this_is_empty = len(np.unique(nib.load(img).get_fdata())) == 1
+        this_is_empty = len(np.unique(nib.load(img).dataobj)) == 1
         is_empty = is_empty and this_is_empty
     return is_empty
 
@@ -152,10 +152,51 @@ def nnUNet_predict(dir_in, dir_out, task_id, model="3d_fullres", folds=None,
                         step_size=step_size, checkpoint_name=chk)
 
 
+@lru_cache(maxsize=8)
+def get_predictor(model_folder, folds, checkpoint_name, step_size, use_mirroring, device, verbose, allow_tqdm):
+    """
+    Create a nnUNetPredictor and load the weights.
+
+    Cached, so that running several images in the same python process (e.g. calling the python api
+    in a loop) does not load the weights from disk every time. Only used with keep_models_loaded=True,
+    because every cached predictor keeps its weights in memory.
+    """
+    # nnUNet 2.2.1
+    if supports_keyword_argument(nnUNetPredictor, "perform_everything_on_gpu"):
+        predictor = nnUNetPredictor(
+            tile_step_size=step_size,
+            use_gaussian=True,
+            use_mirroring=use_mirroring,
+            perform_everything_on_gpu=True,  # for nnunetv2<=2.2.1
+            device=device,
+            verbose=verbose,
+            verbose_preprocessing=verbose,
+            allow_tqdm=allow_tqdm
+        )
+    # nnUNet >= 2.2.2
+    else:
+        predictor = nnUNetPredictor(
+            tile_step_size=step_size,
+            use_gaussian=True,
+            use_mirroring=use_mirroring,
+            perform_everything_on_device=True,  # for nnunetv2>=2.2.2
+            device=device,
+            verbose=verbose,
+            verbose_preprocessing=verbose,
+            allow_tqdm=allow_tqdm
+        )
+    predictor.initialize_from_trained_model_folder(
+        model_folder,
+        use_folds=folds,
+        checkpoint_name=checkpoint_name,
+    )
+    return predictor
+
+
 def nnUNetv2_predict(dir_in, dir_out, task_id, model="3d_fullres", folds=None,
                      trainer="nnUNetTrainer", tta=False,
                      num_threads_preprocessing=3, num_threads_nifti_save=2,
-                     plans="nnUNetPlans", device="cuda", quiet=False, step_size=0.5):
+                     plans="nnUNetPlans", device="cuda", quiet=False, step_size=0.5, keep_models_loaded=False):
     """
     Identical to bash function nnUNetv2_predict
 
@@ -163,24 +204,27 @@ def nnUNetv2_predict(dir_in, dir_out, task_id, model="3d_fullres", folds=None,
             automatically in the model output folder.
             for all folds: None
             for only fold 0: [0]
+    keep_models_loaded: keep the loaded model in memory for the next call with the same model
     """
     dir_in = str(dir_in)
     dir_out = str(dir_out)
 
     model_folder = get_output_folder(task_id, trainer, plans, model)
 
-    assert device in ['cpu', 'cuda',
-                           'mps'], f'-device must be either cpu, mps or cuda. Other devices are not tested/supported. Got: {device}.'
+    assert device in ['cpu', 'cuda', 'mps'] or device.startswith('cuda:'), \
+        f'-device must be either cpu, mps, cuda or cuda:X. Other devices are not tested/supported. Got: {device}.'
     if device == 'cpu':
-        # let's allow torch to use hella threads
-        import multiprocessing
-        torch.set_num_threads(multiprocessing.cpu_count())
+        # let's allow torch to use hella threads (unless limited with OMP_NUM_THREADS, e.g. if running
+        # several cases in parallel)
+        if "OMP_NUM_THREADS" not in os.environ:
+            import multiprocessing
+            torch.set_num_threads(multiprocessing.cpu_count())
         device = torch.device('cpu')
-    elif device == 'cuda':
+    elif device.startswith('cuda'):
         # multithreading in torch doesn't help nnU-Net if run on GPU
         torch.set_num_threads(1)
         # torch.set_num_interop_threads(1)  # throws error if setting the second time
-        device = torch.device('cuda')
+        device = torch.device(device)
     else:
         device = torch.device('mps')
     disable_tta = not tta
@@ -215,41 +259,20 @@ def nnUNetv2_predict(dir_in, dir_out, task_id, model="3d_fullres", folds=None,
     #                       part_id=part_id,
     #                       device=device)
 
-    # nnUNet 2.2.1
-    if supports_keyword_argument(nnUNetPredictor, "perform_everything_on_gpu"):
-        predictor = nnUNetPredictor(
-            tile_step_size=step_size,
-            use_gaussian=True,
-            use_mirroring=not disable_tta,
-            perform_everything_on_gpu=True,  # for nnunetv2<=2.2.1
-            device=device,
-            verbose=verbose,
-            verbose_preprocessing=verbose,
-            allow_tqdm=allow_tqdm
-        )
-    # nnUNet >= 2.2.2
-    else:
-        predictor = nnUNetPredictor(
-            tile_step_size=step_size,
-            use_gaussian=True,
-            use_mirroring=not disable_tta,
-            perform_everything_on_device=True,  # for nnunetv2>=2.2.2
-            device=device,
-            verbose=verbose,
-            verbose_preprocessing=verbose,
-            allow_tqdm=allow_tqdm
-        )
-    predictor.initialize_from_trained_model_folder(
-        model_folder,
-        use_folds=folds,
-        checkpoint_name=chk,
-    )
+    create_predictor = get_predictor if keep_models_loaded else get_predictor.__wrapped__
+    predictor = create_predictor(model_folder, tuple(folds) if folds is not None else None, chk,
+                                 step_size, not disable_tta, device, verbose, allow_tqdm)
     predictor.predict_from_files(dir_in, dir_out,
                                  save_probabilities=save_probabilities, overwrite=not continue_prediction,
                                  num_processes_preprocessing=npp, num_processes_segmentation_export=nps,
                                  folder_with_segs_from_prev_stage=prev_stage_predictions,
                                  num_parts=num_parts, part_id=part_id)
 
+    # The predictor is cached. Do not keep the weights on the GPU until the next image.
+    if keep_models_loaded and device.type == "cuda":
+        predictor.network.cpu()
+        torch.cuda.empty_cache()
+
     # # Use numpy as input. TODO: In entire pipeline do not save to disk
     # input_image = nib.load(Path(dir_in) / "s01_0000.nii.gz")
     # input_data = np.asanyarray(input_image.dataobj).transpose(2, 1, 0)[None,...].astype(np.float32)
@@ -267,16 +290,17 @@ def nnUNetv2_predict(dir_in, dir_out, task_id, model="3d_fullres", folds=None,
     # nib.save(nib.Nifti1Image(seg.astype(np.uint8), affine), Path(dir_out) / "s01.nii.gz")
 
 
-def save_segmentation_nifti(class_map_item, tmp_dir=None, file_out=None, nora_tag=None, header=None, task_name=None, quiet=None):
+def save_segmentation_nifti(class_map_item, tmp_dir=None, file_out=None, nora_tag=None, header=None, task_name=None, quiet=None,
+                            affine=None):
     k, v = class_map_item
     # Have to load img inside of each thread. If passing it as argument a lot slower.
+    # Memory map the raw array instead of decompressing a nifti in every process.
     if not task_name.startswith("total") and not quiet:
         print(f"Creating {v}.nii.gz")
-    img = nib.load(tmp_dir / "s01.nii.gz")
-    img_data = img.get_fdata()
+    img_data = np.load(tmp_dir / "s01.npy", mmap_mode="r")
     binary_img = img_data == k
     output_path = str(file_out / f"{v}.nii.gz")
-    nib.save(nib.Nifti1Image(binary_img.astype(np.uint8), img.affine, header), output_path)
+    nib.save(nib.Nifti1Image(binary_img.view(np.uint8), affine, header), output_path)  # bool -> uint8 without a copy
     if nora_tag != "None":
         subprocess.call(f"/opt/nora/src/node/nora -p {nora_tag} --add {output_path} --addtag mask", shell=True)
 
@@ -288,7 +312,7 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
                          crop_addon=[3,3,3], roi_subset=None, output_type="nifti",
                          statistics=False, quiet=False, verbose=False, test=0, skip_saving=False,
                          device="cuda", exclude_masks_at_border=True, no_derived_masks=False,
-                         v1_order=False):
+                         v1_order=False, keep_models_loaded=False):
     """
     crop: string or a nibabel image
     resample: None or float  (target spacing for all dimensions)
@@ -303,6 +327,8 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
     if file_out is not None:
         file_out = Path(file_out)
     multimodel = type(task_id) is list
+    if roi_subset is not None:
+        roi_subset = set(roi_subset)  # only used for lookups
 
     if img_type == "nifti" and output_type == "dicom":
         raise ValueError("To use output type dicom you also have to use a Dicom image as input.")
@@ -318,9 +344,13 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
         if img_type == "dicom":
             if not quiet: print("Converting dicom to nifti...")
             (tmp_dir / "dcm").mkdir()  # make subdir otherwise this file would be included by nnUNet_predict
-            dcm_to_nifti(file_in, tmp_dir / "dcm" / "converted_dcm.nii.gz", verbose=verbose)
+            # The rt struct export expects the orientation of dicom2nifti
+            # (uncompressed, because it is only read once again below)
+            dcm_to_nifti(file_in, tmp_dir / "dcm" / "converted_dcm.nii", verbose=verbose,
+                         use_dcm2niix=output_type != "dicom")
             file_in_dcm = file_in
-            file_in = tmp_dir / "dcm" / "converted_dcm.nii.gz"
+            # no mmap: otherwise the file can not be removed together with tmp_dir on windows
+            file_in = nib.load(tmp_dir / "dcm" / "converted_dcm.nii", mmap=False)
             
             # for debugging
             # shutil.copy(file_in, file_in_dcm.parent / "converted_dcm_TMP.nii.gz")
@@ -332,7 +362,7 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
 
             # if not multilabel_image:
             #     shutil.copy(file_in, file_out / "input_file.nii.gz")
-            if not quiet: print(f"  found image with shape {nib.load(file_in).shape}")
+            if not quiet: print(f"  found image with shape {file_in.shape}")
 
         if isinstance(file_in, Nifti1Image):
             img_in_orig = file_in
@@ -410,6 +440,7 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
             step_size = 0.5
 
         st = time.time()
+        seg_parts = None  # predicted subparts kept in memory (otherwise they are read from tmp_dir)
         if multimodel:  # if running multiple models
 
             # only compute model parts containing the roi subset
@@ -417,9 +448,8 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
                 part_names = []
                 new_task_id = []
                 for part_name, part_map in class_map_5_parts.items():
-                    if any(organ in roi_subset for organ in part_map.values()):
+                    if not roi_subset.isdisjoint(part_map.values()):
                         # get taskid associated to model part_name
-                        map_partname_to_taskid = {v:k for k,v in map_taskid_to_partname.items()}
                         new_task_id.append(map_partname_to_taskid[part_name])
                         part_names.append(part_name)
                 task_id = new_task_id
@@ -442,16 +472,19 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
                         #                nr_threads_resampling, nr_threads_saving)
                         nnUNetv2_predict(tmp_dir, tmp_dir, tid, model, folds, trainer, tta,
                                          nr_threads_resampling, nr_threads_saving,
-                                         device=device, quiet=quiet, step_size=step_size)
+                                         device=device, quiet=quiet, step_size=step_size,
+                                         keep_models_loaded=keep_models_loaded)
                     # iterate over models (different sets of classes)
                     for img_part in img_parts:
                         (tmp_dir / f"{img_part}.nii.gz").rename(tmp_dir / "parts" / f"{img_part}_{tid}.nii.gz")
-                        seg = nib.load(tmp_dir / "parts" / f"{img_part}_{tid}.nii.gz").get_fdata()
+                        seg = np.asanyarray(nib.load(tmp_dir / "parts" / f"{img_part}_{tid}.nii.gz").dataobj).astype(np.uint8)
+                        # map part labels to labels of the combined map in one pass (instead of one pass per class)
+                        lut = np.zeros(256, dtype=np.uint8)
                         for jdx, class_name in class_map_5_parts[map_taskid_to_partname[tid]].items():
-                            seg_combined[img_part][seg == jdx] = class_map_inv[class_name]
-                # iterate over subparts of image
-                for img_part in img_parts:
-                    nib.save(nib.Nifti1Image(seg_combined[img_part], img_in_rsp.affine), tmp_dir / f"{img_part}.nii.gz")
+                            lut[jdx] = class_map_inv[class_name]
+                        seg = lut[seg]
+                        np.copyto(seg_combined[img_part], seg, where=seg > 0)
+                seg_parts = seg_combined
             elif test == 1:
                 print("WARNING: Using reference seg instead of prediction for testing.")
                 shutil.copy(Path("tests") / "reference_files" / "example_seg.nii.gz", tmp_dir / "s01.nii.gz")
@@ -463,7 +496,8 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
                     #                nr_threads_resampling, nr_threads_saving)
                     nnUNetv2_predict(tmp_dir, tmp_dir, task_id, model, folds, trainer, tta,
                                      nr_threads_resampling, nr_threads_saving,
-                                     device=device, quiet=quiet, step_size=step_size)
+                                     device=device, quiet=quiet, step_size=step_size,
+                                     keep_models_loaded=keep_models_loaded)
             # elif test == 2:
             #     print("WARNING: Using reference seg instead of prediction for testing.")
             #     shutil.copy(Path("tests") / "reference_files" / "example_seg_fast.nii.gz", tmp_dir / f"s01.nii.gz")
@@ -474,27 +508,32 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
 
         # Combine image subparts back to one image
         if do_triple_split:
+            if seg_parts is None:
+                seg_parts = {img_part: np.asanyarray(nib.load(tmp_dir / f"{img_part}.nii.gz").dataobj)
+                             for img_part in img_parts}
             combined_img = np.zeros(img_in_rsp.shape, dtype=np.uint8)
-            combined_img[:,:,:third] = nib.load(tmp_dir / "s01.nii.gz").get_fdata()[:,:,:-margin]
-            combined_img[:,:,third:third*2] = nib.load(tmp_dir / "s02.nii.gz").get_fdata()[:,:,margin-1:-margin]
-            combined_img[:,:,third*2:] = nib.load(tmp_dir / "s03.nii.gz").get_fdata()[:,:,margin-1:]
-            nib.save(nib.Nifti1Image(combined_img, img_in_rsp.affine), tmp_dir / "s01.nii.gz")
-
-        img_pred = nib.load(tmp_dir / "s01.nii.gz")
+            combined_img[:,:,:third] = seg_parts["s01"][:,:,:-margin]
+            combined_img[:,:,third:third*2] = seg_parts["s02"][:,:,margin-1:-margin]
+            combined_img[:,:,third*2:] = seg_parts["s03"][:,:,margin-1:]
+            img_pred = nib.Nifti1Image(combined_img, img_in_rsp.affine)
+        elif seg_parts is not None:
+            img_pred = nib.Nifti1Image(seg_parts["s01"], img_in_rsp.affine)
+        else:
+            img_pred = nib.load(tmp_dir / "s01.nii.gz")
 
         # Currently only relevant for T304 (appendicular bones)
         img_pred = remove_auxiliary_labels(img_pred, task_name)
 
         # Postprocessing multilabel (run here on lower resolution)
         if task_name == "body":
-            img_pred_pp = keep_largest_blob_multilabel(img_pred.get_fdata().astype(np.uint8),
+            img_pred_pp = keep_largest_blob_multilabel(np.asanyarray(img_pred.dataobj).astype(np.uint8),
                                                        class_map[task_name], ["body_trunc"], debug=False, quiet=quiet)
             img_pred = nib.Nifti1Image(img_pred_pp, img_pred.affine)
 
         if task_name == "body":
             vox_vol = np.prod(img_pred.header.get_zooms())
             size_thr_mm3 = 50000 / vox_vol
-            img_pred_pp = remove_small_blobs_multilabel(img_pred.get_fdata().astype(np.uint8),
+            img_pred_pp = remove_small_blobs_multilabel(np.asanyarray(img_pred.dataobj).astype(np.uint8),
                                                         class_map[task_name], ["body_extremities"],
                                                         interval=[size_thr_mm3, 1e10], debug=False, quiet=quiet)
             img_pred = nib.Nifti1Image(img_pred_pp, img_pred.affine)
@@ -527,7 +566,7 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
                 stats_file = stats_dir / "statistics.json"
             else:
                 stats_file = None
-            stats = get_basic_statistics(img_pred.get_fdata(), img_in_rsp, stats_file, 
+            stats = get_basic_statistics(np.asanyarray(img_pred.dataobj), img_in_rsp, stats_file, 
                                          quiet, task_name, exclude_masks_at_border, roi_subset)
             if not quiet: print(f"  calculated in {time.time()-st:.2f}s")
 
@@ -549,7 +588,8 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
 
         check_if_shape_and_affine_identical(img_in_orig, img_pred)
 
-        img_data = img_pred.get_fdata().astype(np.uint8)
+        # read labels as ints directly instead of going through a float64 copy of the image (get_fdata)
+        img_data = np.asanyarray(img_pred.dataobj).astype(np.uint8)
         if save_binary:
             img_data = (img_data > 0).astype(np.uint8)
 
@@ -584,7 +624,10 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
 
             if output_type == "dicom":
                 file_out.mkdir(exist_ok=True, parents=True)
-                save_mask_as_rtstruct(img_data, selected_classes, file_in_dcm, file_out / "segmentations.dcm")
+                # each thread holds one mask of the size of the image
+                nr_threads_rtstruct = 1 if np.prod(img_data.shape) > 512*512*1000 else nr_threads_saving
+                save_mask_as_rtstruct(img_data, selected_classes, file_in_dcm, file_out / "segmentations.dcm",
+                                      nr_threads=nr_threads_rtstruct)
             else:
                 st = time.time()
                 if multilabel_image:
@@ -607,15 +650,15 @@ def nnUNet_predict_image(file_in: Union[str, Path, Nifti1Image], file_out, task_
                         for k, v in selected_classes.items():
                             binary_img = img_data == k
                             output_path = str(file_out / f"{v}.nii.gz")
-                            nib.save(nib.Nifti1Image(binary_img.astype(np.uint8), img_pred.affine, new_header), output_path)
+                            nib.save(nib.Nifti1Image(binary_img.view(np.uint8), img_pred.affine, new_header), output_path)
                             if nora_tag != "None":
                                 subprocess.call(f"/opt/nora/src/node/nora -p {nora_tag} --add {output_path} --addtag mask", shell=True)
                     else:
                         # Code for multithreaded execution
                         #   Speed with different number of threads:
                         #   1: 46s, 2: 24s, 6: 11s, 10: 8s, 14: 8s
-                        nib.save(img_pred, tmp_dir / "s01.nii.gz")
-                        _ = p_map(partial(save_segmentation_nifti, tmp_dir=tmp_dir, file_out=file_out, nora_tag=nora_tag, header=new_header, task_name=task_name, quiet=quiet),
+                        np.save(tmp_dir / "s01.npy", np.asanyarray(img_pred.dataobj))
+                        _ = p_map(partial(save_segmentation_nifti, tmp_dir=tmp_dir, file_out=file_out, nora_tag=nora_tag, header=new_header, task_name=task_name, quiet=quiet, affine=img_pred.affine),
                                 selected_classes.items(), num_cpus=nr_threads_saving, disable=quiet)
 
                         # Multihreaded saving with same functions as in nnUNet -> same speed as p_map
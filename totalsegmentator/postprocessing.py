@@ -13,8 +13,7 @@ from totalsegmentator.map_to_binary import class_map
 def keep_largest_blob(data, debug=False):
     blob_map, nr_of_blobs = ndimage.label(data)
     # Get number of pixels in each blob
-    # counts = list(np.bincount(blob_map.flatten()))  # this will also count background -> bug
-    counts = [np.sum(blob_map == i) for i in range(1, nr_of_blobs + 1)]  # this will not count background
+    counts = np.bincount(blob_map.ravel())[1:]  # remove first element, otherwise would also count background
     if len(counts) == 0: return data  # no foreground
     largest_blob_label = np.argmax(counts) + 1  # +1 because labels start from 1
     if debug: print(f"size of largest blob: {np.max(counts)}")
@@ -150,11 +149,10 @@ def remove_auxiliary_labels(img, task_name):
     task_name_aux = task_name + "_auxiliary"
     if task_name_aux in class_map:
         class_map_aux = class_map[task_name_aux]
-        data = img.get_fdata()
-        # remove auxiliary labels
-        for idx in class_map_aux.keys():
-            data[data == idx] = 0
-        return nib.Nifti1Image(data.astype(np.uint8), img.affine)
+        data = np.asanyarray(img.dataobj).astype(np.uint8)
+        # remove auxiliary labels (all in one pass)
+        data[np.isin(data, list(class_map_aux.keys()))] = 0
+        return nib.Nifti1Image(data, img.affine)
     else:
         return img
 
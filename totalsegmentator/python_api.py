@@ -47,13 +47,16 @@ def totalsegmentator(input: Union[str, Path, Nifti1Image], output: Union[str, Pa
                      force_split=False, output_type="nifti", quiet=False, verbose=False, test=0,
                      skip_saving=False, device="gpu", license_number=None,
                      statistics_exclude_masks_at_border=True, no_derived_masks=False,
-                     v1_order=False, fastest=False, roi_subset_robust=None):
+                     v1_order=False, fastest=False, roi_subset_robust=None, keep_models_loaded=False):
     """
     Run TotalSegmentator from within python.
 
     For explanation of the arguments see description of command line
     arguments in bin/TotalSegmentator.
 
+    keep_models_loaded: keep the loaded models in memory. Makes calling this function several times
+                        (e.g. in a loop over images) faster, but needs more memory.
+
     Return: multilabel Nifti1Image
     """
     if not isinstance(input, Nifti1Image):
@@ -70,9 +73,10 @@ def totalsegmentator(input: Union[str, Path, Nifti1Image], output: Union[str, Pa
     if not quiet:
         print("\nIf you use this tool please cite: https://pubs.rsna.org/doi/10.1148/ryai.230024\n")
 
-    # available devices: gpu | cpu | mps
+    # available devices: gpu | cpu | mps | gpu:X
     if device == "gpu": device = "cuda"
-    if device == "cuda" and not torch.cuda.is_available():
+    if device.startswith("gpu:"): device = device.replace("gpu:", "cuda:")
+    if device.startswith("cuda") and not torch.cuda.is_available():
         print("No GPU detected. Running on CPU. This can be very slow. The '--fast' or the `--roi_subset` option can help to reduce runtime.")
         device = "cpu"
 
@@ -296,14 +300,14 @@ def totalsegmentator(input: Union[str, Path, Nifti1Image], output: Union[str, Pa
                             crop=None, crop_path=None, task_name="total", nora_tag="None", preview=False,
                             save_binary=False, nr_threads_resampling=nr_thr_resamp, nr_threads_saving=1,
                             crop_addon=crop_addon, output_type=output_type, statistics=False,
-                            quiet=quiet, verbose=verbose, test=0, skip_saving=False, device=device)
+                            quiet=quiet, verbose=verbose, test=0, skip_saving=False, device=device,
+                            keep_models_loaded=keep_models_loaded)
         class_map_inv = {v: k for k, v in class_map["total"].items()}
-        crop_mask = np.zeros(organ_seg.shape, dtype=np.uint8)
-        organ_seg_data = organ_seg.get_fdata()
         # roi_subset_crop = [map_to_total[roi] if roi in map_to_total else roi for roi in roi_subset]
         roi_subset_crop = crop if crop is not None else roi_subset
-        for roi in roi_subset_crop:
-            crop_mask[organ_seg_data == class_map_inv[roi]] = 1
+        crop_labels = [class_map_inv[roi] for roi in roi_subset_crop]
+        # one pass over the image for all rois instead of one pass per roi
+        crop_mask = np.isin(np.asanyarray(organ_seg.dataobj), crop_labels).astype(np.uint8)
         crop_mask = nib.Nifti1Image(crop_mask, organ_seg.affine)
         crop_addon = [20,20,20]
         crop = crop_mask
@@ -319,7 +323,8 @@ def totalsegmentator(input: Union[str, Path, Nifti1Image], output: Union[str, Pa
                             crop=None, crop_path=None, task_name="body", nora_tag="None", preview=False,
                             save_binary=True, nr_threads_resampling=nr_thr_resamp, nr_threads_saving=1,
                             crop_addon=crop_addon, output_type=output_type, statistics=False,
-                            quiet=quiet, verbose=verbose, test=0, skip_saving=False, device=device)
+                            quiet=quiet, verbose=verbose, test=0, skip_saving=False, device=device,
+                            keep_models_loaded=keep_models_loaded)
         crop = body_seg
         if verbose: print(f"Rough body segmentation generated in {time.time()-st:.2f}s")
 
@@ -332,8 +337,9 @@ def totalsegmentator(input: Union[str, Path, Nifti1Image], output: Union[str, Pa
                             output_type=output_type, statistics=statistics_fast,
                             quiet=quiet, verbose=verbose, test=test, skip_saving=skip_saving, device=device,
                             exclude_masks_at_border=statistics_exclude_masks_at_border,
-                            no_derived_masks=no_derived_masks, v1_order=v1_order)
-    seg = seg_img.get_fdata().astype(np.uint8)
+                            no_derived_masks=no_derived_masks, v1_order=v1_order,
+                            keep_models_loaded=keep_models_loaded)
+    seg = np.asanyarray(seg_img.dataobj, dtype=np.uint8)  # already uint8; avoids a float64 copy of the image
 
     try:
         # this can result in error if running multiple processes in parallel because all try to write the same file.
@@ -24,7 +24,7 @@ def get_radiomics_features(seg_file, img_file="ct.nii.gz"):
     standard_features = ['shape_Elongation', 'shape_Flatness', 'shape_LeastAxisLength', 'shape_MajorAxisLength', 'shape_Maximum2DDiameterColumn', 'shape_Maximum2DDiameterRow', 'shape_Maximum2DDiameterSlice', 'shape_Maximum3DDiameter', 'shape_MeshVolume', 'shape_MinorAxisLength', 'shape_Sphericity', 'shape_SurfaceArea', 'shape_SurfaceVolumeRatio', 'shape_VoxelVolume', 'firstorder_10Percentile', 'firstorder_90Percentile', 'firstorder_Energy', 'firstorder_Entropy', 'firstorder_InterquartileRange', 'firstorder_Kurtosis', 'firstorder_Maximum', 'firstorder_MeanAbsoluteDeviation', 'firstorder_Mean', 'firstorder_Median', 'firstorder_Minimum', 'firstorder_Range', 'firstorder_RobustMeanAbsoluteDeviation', 'firstorder_RootMeanSquared', 'firstorder_Skewness', 'firstorder_TotalEnergy', 'firstorder_Uniformity', 'firstorder_Variance', 'glcm_Autocorrelation', 'glcm_ClusterProminence', 'glcm_ClusterShade', 'glcm_ClusterTendency', 'glcm_Contrast', 'glcm_Correlation', 'glcm_DifferenceAverage', 'glcm_DifferenceEntropy', 'glcm_DifferenceVariance', 'glcm_Id', 'glcm_Idm', 'glcm_Idmn', 'glcm_Idn', 'glcm_Imc1', 'glcm_Imc2', 'glcm_InverseVariance', 'glcm_JointAverage', 'glcm_JointEnergy', 'glcm_JointEntropy', 'glcm_MCC', 'glcm_MaximumProbability', 'glcm_SumAverage', 'glcm_SumEntropy', 'glcm_SumSquares', 'gldm_DependenceEntropy', 'gldm_DependenceNonUniformity', 'gldm_DependenceNonUniformityNormalized', 'gldm_DependenceVariance', 'gldm_GrayLevelNonUniformity', 'gldm_GrayLevelVariance', 'gldm_HighGrayLevelEmphasis', 'gldm_LargeDependenceEmphasis', 'gldm_LargeDependenceHighGrayLevelEmphasis', 'gldm_LargeDependenceLowGrayLevelEmphasis', 'gldm_LowGrayLevelEmphasis', 'gldm_SmallDependenceEmphasis', 'gldm_SmallDependenceHighGrayLevelEmphasis', 'gldm_SmallDependenceLowGrayLevelEmphasis', 'glrlm_GrayLevelNonUniformity', 'glrlm_GrayLevelNonUniformityNormalized', 'glrlm_GrayLevelVariance', 'glrlm_HighGrayLevelRunEmphasis', 'glrlm_LongRunEmphasis', 'glrlm_LongRunHighGrayLevelEmphasis', 'glrlm_LongRunLowGrayLevelEmphasis', 'glrlm_LowGrayLevelRunEmphasis', 'glrlm_RunEntropy', 'glrlm_RunLengthNonUniformity', 'glrlm_RunLengthNonUniformityNormalized', 'glrlm_RunPercentage', 'glrlm_RunVariance', 'glrlm_ShortRunEmphasis', 'glrlm_ShortRunHighGrayLevelEmphasis', 'glrlm_ShortRunLowGrayLevelEmphasis', 'glszm_GrayLevelNonUniformity', 'glszm_GrayLevelNonUniformityNormalized', 'glszm_GrayLevelVariance', 'glszm_HighGrayLevelZoneEmphasis', 'glszm_LargeAreaEmphasis', 'glszm_LargeAreaHighGrayLevelEmphasis', 'glszm_LargeAreaLowGrayLevelEmphasis', 'glszm_LowGrayLevelZoneEmphasis', 'glszm_SizeZoneNonUniformity', 'glszm_SizeZoneNonUniformityNormalized', 'glszm_SmallAreaEmphasis', 'glszm_SmallAreaHighGrayLevelEmphasis', 'glszm_SmallAreaLowGrayLevelEmphasis', 'glszm_ZoneEntropy', 'glszm_ZonePercentage', 'glszm_ZoneVariance', 'ngtdm_Busyness', 'ngtdm_Coarseness', 'ngtdm_Complexity', 'ngtdm_Contrast', 'ngtdm_Strength']
 
     try:
-        if len(np.unique(nib.load(seg_file).get_fdata())) > 1:
+        if len(np.unique(nib.load(seg_file).dataobj)) > 1:
             settings = {}
             # settings["binWidth"] = 25
             # settings["resampledPixelSpacing"] = None  # [3,3,3] is an example for defining resampling (voxels with size 3x3x3mm)
@@ -92,6 +92,17 @@ def touches_border(mask):
     return False
 
 
+def labels_touching_border(seg, nr_labels):
+    """
+    Same check as touches_border, but for all labels of a multilabel segmentation at once.
+
+    returns: boolean array with one entry per label
+    """
+    border = [seg[1, :, :], seg[-2, :, :], seg[:, 1, :], seg[:, -2, :], seg[:, :, 1], seg[:, :, -2]]
+    border = np.concatenate([b.ravel() for b in border])
+    return np.bincount(border, minlength=nr_labels)[:nr_labels] > 0
+
+
 def get_basic_statistics(seg: np.array, 
                          ct_file: Union[Path, Nifti1Image], 
                          file_out: Union[Path, None]=None, 
@@ -111,20 +122,24 @@ def get_basic_statistics(seg: np.array,
     if roi_subset is not None:
         class_map_stats = {k: v for k, v in class_map_stats.items() if v in roi_subset}
     
+    # Get volume and intensity sum of all labels in one pass over the image instead of one pass per label
+    if not np.issubdtype(seg.dtype, np.integer):
+        seg = seg.astype(np.uint8)
+    nr_labels = max(class_map_stats, default=0) + 1
+    voxel_counts = np.bincount(seg.ravel(), minlength=nr_labels)
+    intensity_sums = np.bincount(seg.ravel(), weights=ct.ravel(), minlength=nr_labels)
+    at_border = labels_touching_border(seg, nr_labels)
+
     stats = {}
     for k, mask_name in tqdm(class_map_stats.items(), disable=quiet):
         stats[mask_name] = {}
-        # data = nib.load(mask).get_fdata()  # loading: 0.6s
-        data = seg == k  # 0.18s
-        if touches_border(data) and exclude_masks_at_border:
+        if at_border[k] and exclude_masks_at_border:
             # print(f"WARNING: {mask_name} touches border. Skipping.")
             stats[mask_name]["volume"] = 0.0
             stats[mask_name]["intensity"] = 0.0
         else:
-            stats[mask_name]["volume"] = data.sum() * vox_vol  # vol in mm3; 0.2s
-            roi_mask = (data > 0).astype(np.uint8)  # 0.16s
-            # stats[mask_name]["intensity"] = ct[roi_mask > 0].mean().round(2) if roi_mask.sum() > 0 else 0.0  # 3.0s
-            stats[mask_name]["intensity"] = np.average(ct, weights=roi_mask).round(2) if roi_mask.sum() > 0 else 0.0  # 0.9s
+            stats[mask_name]["volume"] = voxel_counts[k] * vox_vol  # vol in mm3
+            stats[mask_name]["intensity"] = (intensity_sums[k] / voxel_counts[k]).round(2) if voxel_counts[k] > 0 else 0.0
 
     if file_out is not None:
         # For nora json is good